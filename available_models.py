@@ -4,8 +4,10 @@ Available Models Configuration
 Simple model definitions with their LiteLLM identifiers
 """
 
-# Available models with their LiteLLM model identifiers
-AVAILABLE_MODELS = {
+from types import MappingProxyType
+
+# Available models with their LiteLLM model identifiers (read-only)
+AVAILABLE_MODELS = MappingProxyType({
     # Anthropic Direct
     'claude-3-5-sonnet': 'claude-3-5-sonnet-20241022',
     'claude-3-haiku': 'claude-3-haiku-20240307',
@@ -22,10 +24,10 @@ AVAILABLE_MODELS = {
     # Other Providers
     'cohere-command-r-plus': 'cohere/command-r-plus',
     'gemini-1-5-pro': 'gemini/gemini-1.5-pro',
-}
+})
 
-# Model display names for logging
-MODEL_NAMES = {
+# Model display names for logging (read-only)
+MODEL_NAMES = MappingProxyType({
     'claude-3-5-sonnet': 'Claude 3.5 Sonnet (Direct)',
     'claude-3-haiku': 'Claude 3 Haiku (Direct)',
     'gpt-4o': 'GPT-4o',
@@ -35,7 +37,7 @@ MODEL_NAMES = {
     'claude-3-haiku-bedrock': 'Claude 3 Haiku (Bedrock)',
     'cohere-command-r-plus': 'Cohere Command R+',
     'gemini-1-5-pro': 'Gemini 1.5 Pro',
-}
+})
 
 def get_model_id(model_key: str) -> str:
     """Get the LiteLLM model ID for a model key"""
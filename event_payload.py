@@ -4,18 +4,20 @@ Event Payload Structure
 Simple event payload for LLM requests with fallback order
 """
 
-import json
-from typing import List, Optional, Dict, Any
-from dataclasses import dataclass
+from typing import List, Optional, Dict, Any, Union
+import msgspec
 
-@dataclass
-class EventPayload:
-    """Simple event payload with fallback order"""
+class EventPayload(msgspec.Struct, frozen=True):
+    """Simple event payload with fallback order (decoded straight from JSON by msgspec)"""
     prompt: str
     models: List[str]  # First model is primary, rest are fallbacks in order
     max_tokens: int = 4000
     temperature: float = 0.7
     request_id: Optional[str] = None
+    race_first_n: int = 1  # Call the first N models concurrently, first success wins
+    system_prompt: Optional[str] = None  # Stable prefix, prompt-cached on Claude models
+    tools: Optional[List[Dict[str, Any]]] = None  # OpenAI-style tool definitions
+    batchable: bool = False  # May wait for a provider batch API in process_batch_offline
     
     @property
     def primary_model(self) -> str:
@@ -29,28 +31,21 @@ class EventPayload:
     
     def to_dict(self) -> Dict[str, Any]:
         """Convert to dictionary"""
-        return {
-            'prompt': self.prompt,
-            'models': self.models,
-            'max_tokens': self.max_tokens,
-            'temperature': self.temperature,
-            'request_id': self.request_id
-        }
+        return msgspec.structs.asdict(self)
     
     def to_json(self) -> str:
         """Convert to JSON string"""
-        return json.dumps(self.to_dict(), indent=2)
+        return msgspec.json.encode(self).decode()
     
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> 'EventPayload':
         """Create from dictionary"""
-        return cls(**data)
+        return msgspec.convert(data, type=cls)
     
     @classmethod
-    def from_json(cls, json_str: str) -> 'EventPayload':
-        """Create from JSON string"""
-        data = json.loads(json_str)
-        return cls.from_dict(data)
+    def from_json(cls, json_str: Union[str, bytes]) -> 'EventPayload':
+        """Create from JSON string or bytes, validating field types"""
+        return msgspec.json.decode(json_str, type=cls)
 
 # Example payloads for common scenarios
 EXAMPLE_PAYLOADS = {
@@ -80,7 +75,8 @@ EXAMPLE_PAYLOADS = {
             "gpt-4o-mini",
             "claude-3-haiku-bedrock",
             "claude-3-5-sonnet"
-        ]
+        ],
+        race_first_n=2
     ),
     
     "cost_first": EventPayload(
@@ -127,7 +123,8 @@ def get_example_payload(strategy: str, prompt: str) -> EventPayload:
         prompt=prompt,
         models=example.models,
         max_tokens=example.max_tokens,
-        temperature=example.temperature
+        temperature=example.temperature,
+        race_first_n=example.race_first_n
     )
 
 if __name__ == "__main__":
@@ -143,4 +140,4 @@ if __name__ == "__main__":
     # Show JSON example
     example = get_example_payload("quality_first", "Explain machine learning")
     print("JSON Example:")
-    print(example.to_json())
\ No newline at end of file
+    print(msgspec.json.format(example.to_json(), indent=2))
\ No newline at end of file
@@ -5,17 +5,33 @@ Processes event payloads with fallback order using available models
 """
 
 import os
+import asyncio
+import importlib.util
 import logging
+import random
+import threading
 import time
-from typing import Dict, Any, Optional
-from dataclasses import dataclass
+from collections import defaultdict
+from functools import partial
+from typing import Dict, Any, AsyncIterator, Awaitable, Callable, Iterator, List, Optional, Tuple
+from dataclasses import dataclass, replace
 from dotenv import load_dotenv
+import msgspec
+import orjson
 import litellm
-from litellm import completion
+from litellm import acompletion
+
+# Optional faster event loop (libuv based, Linux/macOS only)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # Import our simple configurations
 from available_models import AVAILABLE_MODELS, MODEL_NAMES, get_model_id, get_model_name
 from event_payload import EventPayload
+from response_cache import ResponseCache
+from provider_batches import batch_provider, run_provider_batch
 
 # Load environment variables
 load_dotenv()
@@ -27,22 +43,153 @@ logger = logging.getLogger(__name__)
 # Suppress LiteLLM debug logs
 litellm.set_verbose = False
 
-@dataclass
+# Event loop used by the blocking API, uvloop when installed
+EVENT_LOOP_FACTORY = uvloop.new_event_loop if uvloop else asyncio.new_event_loop
+
+# Anthropic ignores cache_control on prefixes shorter than this
+PROMPT_CACHE_MIN_TOKENS = 1024
+
+# Rough token estimate, avoids running a tokenizer on every call
+CHARS_PER_TOKEN = 4
+
+# Retry policy for throttling (429) and transient server errors (5xx).
+# Other failures are not retried, the fallback loop moves straight to the next model.
+MAX_RETRIES = 3
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+RETRY_JITTER = 0.5
+RECOVERABLE_ERRORS = (
+    litellm.RateLimitError,
+    litellm.InternalServerError,
+    litellm.BadGatewayError,
+    litellm.ServiceUnavailableError,
+)
+
+# Circuit breaker: after CIRCUIT_FAILURE_THRESHOLD failures within CIRCUIT_WINDOW
+# seconds a model is skipped for CIRCUIT_COOLDOWN seconds, then a single probe
+# request decides whether it is back.
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_WINDOW = 10.0
+CIRCUIT_COOLDOWN = 30.0
+
+# Smallest group of same-model payloads worth sending to a provider batch API
+OFFLINE_BATCH_MIN_SIZE = 10
+
+# A model key resolved once per payload: (model_key, model_id, model_name)
+ResolvedModel = Tuple[str, str, str]
+
+def retry_delay(error: Exception, attempt: int) -> Optional[float]:
+    """
+    Seconds to wait before retrying a recoverable error
+    
+    Honors the provider's Retry-After header when present, otherwise uses
+    exponential backoff with jitter. Returns None when the provider asks us
+    to wait longer than RETRY_MAX_DELAY, in which case falling back is cheaper.
+    """
+    response = getattr(error, 'response', None)
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    if retry_after:
+        try:
+            delay = float(retry_after)
+            return delay if delay <= RETRY_MAX_DELAY else None
+        except ValueError:
+            pass
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt * (1 + random.uniform(0, RETRY_JITTER)))
+
+def supports_prompt_caching(model_id: str) -> bool:
+    """Check whether a LiteLLM model ID is an Anthropic model that honors cache_control"""
+    return model_id.startswith('claude') or (model_id.startswith('bedrock/') and 'anthropic.' in model_id)
+
+def estimate_prefix_tokens(payload: EventPayload) -> int:
+    """Estimate the token count of the stable prefix (tools + system prompt)"""
+    chars = len(payload.system_prompt or '')
+    if payload.tools:
+        chars += len(orjson.dumps(payload.tools))
+    return chars // CHARS_PER_TOKEN
+
+@dataclass(slots=True)
+class Attempt:
+    """One entry in a response's attempt history"""
+    model: str
+    name: str
+    status: str  # 'success', 'failed' or 'skipped' (circuit open)
+    error: str = ''
+
+@dataclass(slots=True)
+class CircuitState:
+    """Recent failure tracking for one model"""
+    fail_count: int = 0
+    window_start: float = 0.0
+    opened_at: Optional[float] = None  # Set while the circuit is open
+    probing: bool = False  # A half-open probe request is in flight
+
+@dataclass(slots=True)
+class LazyEmbedding:
+    """A payload's prompt embedding, computed on first use and shared by every model it tries"""
+    compute: Callable[[], Awaitable[Any]]
+    task: Optional[asyncio.Future] = None
+    
+    async def get(self) -> Any:
+        """Get the embedding, starting the computation on the first call"""
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.compute())
+        # Shielded so a cancelled race loser does not cancel it for the others
+        return await asyncio.shield(self.task)
+
+@dataclass(slots=True, frozen=True)
 class SimpleResponse:
     """Simple response structure"""
     success: bool
     content: Optional[str] = None
+    tool_calls: Optional[list] = None
     model_used: Optional[str] = None
     cost: Optional[float] = None
     usage: Optional[Dict[str, Any]] = None
     error: Optional[str] = None
-    attempts: Optional[list] = None
+    attempts: Optional[List[Attempt]] = None
+    cached: bool = False  # Served from the response cache without a provider call
 
 class SimpleLLMHandler:
-    def __init__(self):
-        """Initialize the handler"""
+    def __init__(self, semantic_cache: bool = False, http2: bool = False):
+        """
+        Initialize the handler
+        
+        Args:
+            semantic_cache: Also serve paraphrased low-temperature prompts from
+                earlier responses (requires the optional fastembed package)
+            http2: Talk to providers over HTTP/2 (requires httpx[http2]). This is
+                a LiteLLM-wide setting, so it applies to every handler in the process.
+        """
         self._setup_api_keys()
-        logger.info(f"✅ Handler initialized with {len(AVAILABLE_MODELS)} available models")
+        
+        # model_key -> acompletion bound to its model and pre-resolved provider
+        self._dispatch = self._build_dispatch()
+        
+        if http2:
+            self._enable_http2()
+        
+        # Long-lived event loop for the blocking API, run on its own thread so
+        # process() can be called from any number of threads. LiteLLM pools
+        # keep-alive connections per event loop, so sharing one loop across
+        # calls avoids a fresh TCP + TLS handshake on every request. Started on
+        # the first blocking call, async-only callers never pay for it.
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[threading.Thread] = None
+        self._loop_lock = threading.Lock()
+        
+        # Exact-match cache for deterministic calls
+        self.cache = ResponseCache()
+        
+        # Optional similarity cache for paraphrased prompts
+        self.semantic_cache = None
+        if semantic_cache:
+            from semantic_cache import SemanticCache
+            self.semantic_cache = SemanticCache()
+        
+        # Per-model circuit breakers, so known-broken models are skipped instantly
+        self._breaker: Dict[str, CircuitState] = defaultdict(CircuitState)
+        
+        logger.info("✅ Handler initialized with %d available models", len(AVAILABLE_MODELS))
     
     def _setup_api_keys(self):
         """Set up API keys for all providers"""
@@ -61,24 +208,192 @@ class SimpleLLMHandler:
             if value:
                 os.environ[key] = value
     
-    def _call_model(self, model_key: str, prompt: str, max_tokens: int, temperature: float) -> Dict[str, Any]:
-        """Call a specific model"""
-        model_id = get_model_id(model_key)
-        model_name = get_model_name(model_key)
+    def _build_dispatch(self) -> Dict[str, Callable[..., Awaitable[Any]]]:
+        """Resolve each model's provider once, so calls skip LiteLLM's provider routing"""
+        dispatch = {}
+        for model_key, model_id in AVAILABLE_MODELS.items():
+            # Provider SDK retries are off, _acompletion_with_retries is the only retry policy
+            try:
+                _, provider, _, _ = litellm.get_llm_provider(model_id)
+                dispatch[model_key] = partial(acompletion, model=model_id, custom_llm_provider=provider, max_retries=0)
+            except Exception:
+                # Unknown to this LiteLLM version, leave the routing to each call
+                dispatch[model_key] = partial(acompletion, model=model_id, max_retries=0)
+        return dispatch
+    
+    def _enable_http2(self):
+        """Switch LiteLLM to its httpx transport with HTTP/2 multiplexing"""
+        if importlib.util.find_spec('h2') is None:
+            logger.warning("⚠️ HTTP/2 requested but the h2 package is missing (pip install 'httpx[http2]'), staying on HTTP/1.1")
+            return
+        litellm.http2 = True
+        logger.info("🔀 HTTP/2 enabled for provider connections")
+    
+    def _build_messages(self, model_id: str, payload: EventPayload) -> List[Dict[str, Any]]:
+        """Build the chat messages, marking long system prompts as cacheable for Claude models"""
+        messages = []
+        
+        if payload.system_prompt:
+            system_content = payload.system_prompt
+            if supports_prompt_caching(model_id) and estimate_prefix_tokens(payload) >= PROMPT_CACHE_MIN_TOKENS:
+                # Cache the stable prefix (tools + system), billed at ~10% of input price on reuse
+                system_content = [{
+                    "type": "text",
+                    "text": payload.system_prompt,
+                    "cache_control": {"type": "ephemeral"}
+                }]
+            messages.append({"role": "system", "content": system_content})
+        
+        messages.append({"role": "user", "content": payload.prompt})
+        return messages
+    
+    def _completion_params(self, model_id: str, payload: EventPayload) -> Dict[str, Any]:
+        """Build the acompletion arguments for a payload (the model is bound by the dispatch table)"""
+        params = {
+            'messages': self._build_messages(model_id, payload),
+            'max_tokens': payload.max_tokens,
+            'temperature': payload.temperature,
+        }
+        if payload.tools:
+            params['tools'] = payload.tools
+        return params
+    
+    async def _acompletion_with_retries(self, model_key: str, model_name: str, **kwargs):
+        """Call a model's acompletion, retrying throttles and transient server errors with backoff"""
+        call = self._dispatch[model_key]
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                return await call(**kwargs)
+            except RECOVERABLE_ERRORS as e:
+                delay = retry_delay(e, attempt)
+                if attempt == MAX_RETRIES or delay is None:
+                    raise
+                logger.warning("⏳ %s returned %s, retrying in %.1fs (%d/%d)", model_name, e.status_code, delay, attempt + 1, MAX_RETRIES)
+                await asyncio.sleep(delay)
+    
+    def _content_hash(self, payload: EventPayload) -> Optional[bytes]:
+        """Hash a payload's content once for cache lookups across every model it tries"""
+        if not self.cache.is_cacheable(payload.temperature):
+            return None
+        return self.cache.content_hash(payload.prompt, payload.system_prompt, payload.tools)
+    
+    def _prompt_embedding(self, payload: EventPayload) -> Optional[LazyEmbedding]:
+        """Prepare a payload's prompt embedding, computed only once an exact cache lookup misses"""
+        if not self.semantic_cache or not self.semantic_cache.is_cacheable(payload.temperature) or payload.tools:
+            return None
+        return LazyEmbedding(partial(asyncio.to_thread, self.semantic_cache.embed, payload.prompt))
+    
+    def _circuit_allows(self, model_key: str) -> Tuple[bool, bool]:
+        """
+        Check whether a model may be called, letting one probe through after the cooldown
+        
+        Returns:
+            (allowed, probe) where probe marks the caller as the single half-open
+            probe; only that caller may settle the probe afterwards
+        """
+        state = self._breaker[model_key]
+        if state.opened_at is None:
+            return True, False
+        if time.monotonic() - state.opened_at < CIRCUIT_COOLDOWN or state.probing:
+            return False, False
+        state.probing = True
+        return True, True
+    
+    def _record_success(self, model_key: str):
+        """Close the circuit after a successful call (any success proves the model is back)"""
+        state = self._breaker[model_key]
+        if state.opened_at is not None:
+            logger.info("🔌 Circuit closed for %s", get_model_name(model_key))
+        self._breaker[model_key] = CircuitState()
+    
+    def _record_failure(self, model_key: str, error: Exception, probe: bool = False):
+        """Count a failed call, opening the circuit once the threshold is reached"""
+        state = self._breaker[model_key]
+        
+        # The probe's circuit may have been closed meanwhile by another call's success
+        probe = probe and state.probing
+        if probe:
+            state.probing = False
+        
+        # Bad requests say nothing about the provider's health
+        if isinstance(error, litellm.BadRequestError):
+            return
+        
+        now = time.monotonic()
+        if probe:
+            state.opened_at = now
+            logger.warning("🔌 Circuit re-opened for %s, probe failed", get_model_name(model_key))
+            return
+        
+        if now - state.window_start > CIRCUIT_WINDOW:
+            state.fail_count = 0
+            state.window_start = now
+        state.fail_count += 1
+        if state.fail_count >= CIRCUIT_FAILURE_THRESHOLD and state.opened_at is None:
+            state.opened_at = now
+            logger.warning("🔌 Circuit opened for %s after %d failures, skipping for %.0fs", get_model_name(model_key), state.fail_count, CIRCUIT_COOLDOWN)
+    
+    def _release_probe(self, model_key: str, probe: bool):
+        """Let another request probe the model when the probe was cancelled"""
+        if probe:
+            self._breaker[model_key].probing = False
+    
+    async def _call_model(self, model: ResolvedModel, payload: EventPayload,
+                          content_hash: Optional[bytes] = None,
+                          lazy_embedding: Optional[LazyEmbedding] = None) -> Dict[str, Any]:
+        """Call a specific model (content_hash and lazy_embedding are the payload's shared cache lookups)"""
+        model_key, model_id, model_name = model
+        max_tokens = payload.max_tokens
+        temperature = payload.temperature
+        
+        # Serve deterministic repeats from the cache
+        cache_key = None
+        if self.cache.is_cacheable(temperature):
+            if content_hash is None:
+                content_hash = self._content_hash(payload)
+            cache_key = self.cache.make_key(model_key, content_hash, max_tokens, temperature)
+            cached = self.cache.get(cache_key)
+            if cached:
+                logger.info("⚡ %s served from cache", model_name)
+                return dict(cached, cost=0.0, cached=True)
+        
+        # Fall back to a similarity match on paraphrased prompts (plain prompts only)
+        semantic_namespace = (model_key, max_tokens, payload.system_prompt)
+        embedding = None
+        if lazy_embedding is None:
+            lazy_embedding = self._prompt_embedding(payload)
+        if lazy_embedding is not None:
+            embedding = await lazy_embedding.get()
+            similar = self.semantic_cache.search(semantic_namespace, embedding)
+            if similar:
+                logger.info("⚡ %s served from semantic cache", model_name)
+                return dict(similar, cost=0.0, cached=True)
+        
+        # Skip models whose circuit is open
+        allowed, probe = self._circuit_allows(model_key)
+        if not allowed:
+            logger.info("⏭️ Skipping %s, circuit open", model_name)
+            return {
+                'success': False,
+                'skipped': True,
+                'error': f"{model_name} skipped: circuit open"
+            }
         
         try:
-            logger.info(f"🔄 Trying {model_name}...")
+            logger.info("🔄 Trying %s...", model_name)
             
             # Make the API call
-            response = completion(
-                model=model_id,
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=max_tokens,
-                temperature=temperature
+            response = await self._acompletion_with_retries(
+                model_key,
+                model_name,
+                **self._completion_params(model_id, payload)
             )
+            self._record_success(model_key)
             
             # Extract response data
-            content = response.choices[0].message.content
+            message = response.choices[0].message
+            content = message.content
+            tool_calls = getattr(message, 'tool_calls', None)
             usage = response.usage._asdict() if hasattr(response.usage, '_asdict') else dict(response.usage)
             
             # Calculate cost if available
@@ -88,25 +403,112 @@ class SimpleLLMHandler:
             except:
                 pass
             
-            logger.info(f"✅ {model_name} successful")
+            logger.info("✅ %s successful", model_name)
             
-            return {
+            result = {
                 'success': True,
                 'content': content,
+                'tool_calls': tool_calls,
                 'model_used': model_id,
                 'usage': usage,
                 'cost': cost
             }
+            if cache_key:
+                self.cache.set(cache_key, result)
+            if embedding is not None:
+                self.semantic_cache.add(semantic_namespace, embedding, result)
+            return result
             
+        except asyncio.CancelledError:
+            self._release_probe(model_key, probe)
+            raise
+        
         except Exception as e:
+            self._record_failure(model_key, e, probe)
             error_msg = f"{model_name} failed: {str(e)}"
-            logger.error(f"❌ {error_msg}")
+            logger.error("❌ %s", error_msg)
             return {
                 'success': False,
                 'error': error_msg
             }
     
+    async def aclose(self):
+        """Close LiteLLM's pooled provider connections"""
+        await litellm.close_litellm_async_clients()
+    
+    def close(self):
+        """Close pooled provider connections and the event loop used by the blocking API"""
+        with self._loop_lock:
+            loop, thread = self._loop, self._loop_thread
+            self._loop = self._loop_thread = None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown_loop(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+    
+    async def _shutdown_loop(self):
+        """Close pooled connections and cancel leftover tasks (e.g. LiteLLM's logging worker) on the blocking loop"""
+        await self.aclose()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.get_running_loop().shutdown_asyncgens()
+    
+    def __enter__(self) -> 'SimpleLLMHandler':
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    async def __aenter__(self) -> 'SimpleLLMHandler':
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+    
+    def _blocking_loop(self) -> asyncio.AbstractEventLoop:
+        """Get the blocking API's event loop, starting its thread on first use"""
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = EVENT_LOOP_FACTORY()
+                self._loop_thread = threading.Thread(target=self._loop.run_forever, name='llm-handler-loop', daemon=True)
+                self._loop_thread.start()
+            return self._loop
+    
+    def _run_blocking(self, coro):
+        """Run a coroutine on the handler's event loop and wait for its result"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            coro.close()
+            raise RuntimeError("The blocking API cannot be called from a running event loop, await the async variant instead")
+        
+        future = asyncio.run_coroutine_threadsafe(coro, self._blocking_loop())
+        try:
+            return future.result()
+        except BaseException:
+            # Stop the coroutine too when the caller is interrupted
+            future.cancel()
+            raise
+    
     def process(self, payload: EventPayload) -> SimpleResponse:
+        """
+        Process an event payload with fallback order (blocking)
+        
+        Args:
+            payload: EventPayload with prompt and ordered list of models
+            
+        Returns:
+            SimpleResponse with results
+        """
+        return self._run_blocking(self.aprocess(payload))
+    
+    async def aprocess(self, payload: EventPayload) -> SimpleResponse:
         """
         Process an event payload with fallback order
         
@@ -117,65 +519,314 @@ class SimpleLLMHandler:
             SimpleResponse with results
         """
         
-        logger.info(f"🚀 Processing request (ID: {payload.request_id})")
-        logger.info(f"📝 Prompt: {payload.prompt[:100]}{'...' if len(payload.prompt) > 100 else ''}")
-        logger.info(f"🎯 Model order: {payload.models}")
+        if logger.isEnabledFor(logging.INFO):
+            prompt_preview = payload.prompt[:100] + ('...' if len(payload.prompt) > 100 else '')
+            logger.info("🚀 Processing request (ID: %s)", payload.request_id)
+            logger.info("📝 Prompt: %s", prompt_preview)
+            logger.info("🎯 Model order: %s", payload.models)
+        
+        # Resolve every model once up front, failing fast on unknown keys
+        models = [(key, get_model_id(key), get_model_name(key)) for key in payload.models]
+        content_hash = self._content_hash(payload)
+        lazy_embedding = self._prompt_embedding(payload)
+        attempts: List[Attempt] = []
+        start = 0
         
-        attempts = []
+        # Race the first N models concurrently when requested
+        race_count = min(payload.race_first_n, len(models))
+        if race_count > 1:
+            winner = await self._race_models(models[:race_count], payload, attempts, content_hash, lazy_embedding)
+            if winner:
+                model, result = winner
+                return self._success_response(model, result, attempts)
+            start = race_count
         
-        # Try each model in order
-        for i, model_key in enumerate(payload.models):
+        # Try each remaining model in order
+        for i, model in enumerate(models[start:], start):
             is_primary = (i == 0)
-            model_name = get_model_name(model_key)
+            model_name = model[2]
             
             if is_primary:
-                logger.info(f"🎯 Primary model: {model_name}")
+                logger.info("🎯 Primary model: %s", model_name)
             else:
-                logger.info(f"🔄 Fallback #{i}: {model_name}")
+                logger.info("🔄 Fallback #%d: %s", i, model_name)
             
-            result = self._call_model(
-                model_key,
-                payload.prompt,
-                payload.max_tokens,
-                payload.temperature
-            )
+            result = await self._call_model(model, payload, content_hash, lazy_embedding)
             
-            attempts.append({
-                'model': model_key,
-                'name': model_name,
-                'status': 'success' if result['success'] else 'failed',
-                'error': result.get('error', '')
-            })
+            attempts.append(self._attempt_record(model, result))
             
             if result['success']:
-                logger.info(f"✅ Success with {model_name}")
-                return SimpleResponse(
-                    success=True,
-                    content=result['content'],
-                    model_used=model_key,
-                    cost=result.get('cost'),
-                    usage=result.get('usage'),
-                    attempts=attempts
-                )
+                return self._success_response(model, result, attempts)
         
         # All models failed
         error_msg = f"All {len(payload.models)} models failed"
-        logger.error(f"💀 {error_msg}")
+        logger.error("💀 %s", error_msg)
         
         return SimpleResponse(
             success=False,
             error=error_msg,
             attempts=attempts
         )
+    
+    def stream(self, payload: EventPayload) -> Iterator[str]:
+        """
+        Stream the response text for an event payload with fallback order (blocking)
+        
+        Args:
+            payload: EventPayload with prompt and ordered list of models
+            
+        Yields:
+            Text chunks as they arrive from the provider
+        """
+        chunks = self.astream(payload)
+        try:
+            while True:
+                try:
+                    yield self._run_blocking(self._next_chunk(chunks))
+                except StopAsyncIteration:
+                    return
+        finally:
+            self._run_blocking(chunks.aclose())
+    
+    @staticmethod
+    async def _next_chunk(chunks: AsyncIterator[str]) -> str:
+        """Await the next chunk of an async stream"""
+        return await chunks.__anext__()
+    
+    async def astream(self, payload: EventPayload) -> AsyncIterator[str]:
+        """
+        Stream the response text for an event payload with fallback order
+        
+        A failing model is only swapped for the next one while nothing has been
+        yielded yet; text already sent cannot be taken back, so a mid-stream
+        failure is raised to the caller. Streamed responses are not cached.
+        
+        Args:
+            payload: EventPayload with prompt and ordered list of models
+            
+        Yields:
+            Text chunks as they arrive from the provider
+        """
+        logger.info("🚀 Streaming request (ID: %s)", payload.request_id)
+        logger.info("🎯 Model order: %s", payload.models)
+        
+        models = [(key, get_model_id(key), get_model_name(key)) for key in payload.models]
+        errors = []
+        
+        for model_key, model_id, model_name in models:
+            allowed, probe = self._circuit_allows(model_key)
+            if not allowed:
+                logger.info("⏭️ Skipping %s, circuit open", model_name)
+                errors.append(f"{model_name} skipped: circuit open")
+                continue
+            
+            emitted = False
+            try:
+                logger.info("🌊 Streaming from %s...", model_name)
+                response = await self._acompletion_with_retries(
+                    model_key,
+                    model_name,
+                    stream=True,
+                    **self._completion_params(model_id, payload)
+                )
+                try:
+                    async for chunk in response:
+                        text = chunk.choices[0].delta.content if chunk.choices else None
+                        if text:
+                            emitted = True
+                            yield text
+                finally:
+                    # Stop generation and release the connection on early exit, cancel or failure
+                    await response.aclose()
+                self._record_success(model_key)
+                logger.info("✅ %s stream complete", model_name)
+                return
+            
+            except (asyncio.CancelledError, GeneratorExit):
+                self._release_probe(model_key, probe)
+                raise
+            
+            except Exception as e:
+                self._record_failure(model_key, e, probe)
+                if emitted:
+                    logger.error("❌ %s failed mid-stream: %s", model_name, e)
+                    raise
+                error_msg = f"{model_name} failed: {str(e)}"
+                logger.error("❌ %s", error_msg)
+                errors.append(error_msg)
+        
+        error_msg = f"All {len(models)} models failed"
+        logger.error("💀 %s", error_msg)
+        raise RuntimeError(f"{error_msg}: {'; '.join(errors)}")
+    
+    async def _race_models(self, models: List[ResolvedModel], payload: EventPayload, attempts: List[Attempt],
+                           content_hash: Optional[bytes] = None,
+                           lazy_embedding: Optional[LazyEmbedding] = None) -> Optional[Tuple[ResolvedModel, Dict[str, Any]]]:
+        """Call several models concurrently and return the first successful (model, result)"""
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("🏁 Racing %d models: %s", len(models), [model[0] for model in models])
+        
+        tasks = {
+            asyncio.create_task(self._call_model(model, payload, content_hash, lazy_embedding)): model
+            for model in models
+        }
+        pending = set(tasks)
+        
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    model = tasks[task]
+                    result = task.result()
+                    attempts.append(self._attempt_record(model, result))
+                    if result['success']:
+                        return model, result
+        finally:
+            # Cancel the losers so they stop holding connections
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        
+        return None
+    
+    def _attempt_record(self, model: ResolvedModel, result: Dict[str, Any]) -> Attempt:
+        """Build an attempt history entry for a model call result"""
+        model_key, _, model_name = model
+        return Attempt(
+            model=model_key,
+            name=model_name,
+            status='success' if result['success'] else 'skipped' if result.get('skipped') else 'failed',
+            error=result.get('error', '')
+        )
+    
+    def _success_response(self, model: ResolvedModel, result: Dict[str, Any], attempts: List[Attempt]) -> SimpleResponse:
+        """Build the response for a successful model call"""
+        model_key, _, model_name = model
+        logger.info("✅ Success with %s", model_name)
+        return SimpleResponse(
+            success=True,
+            content=result['content'],
+            tool_calls=result.get('tool_calls'),
+            model_used=model_key,
+            cost=result.get('cost'),
+            usage=result.get('usage'),
+            attempts=attempts,
+            cached=result.get('cached', False)
+        )
+    
+    async def _run(self, payload: EventPayload, semaphore: asyncio.Semaphore) -> SimpleResponse:
+        """Process a single payload while holding a concurrency slot, reporting errors as a failed response"""
+        async with semaphore:
+            try:
+                return await self.aprocess(payload)
+            except Exception as e:
+                # One bad payload must not discard the rest of the batch
+                logger.error("❌ Request %s failed: %s", payload.request_id, e)
+                return SimpleResponse(success=False, error=str(e), attempts=[])
+    
+    async def process_batch(self, payloads: List[EventPayload], concurrency: int = 8) -> List[SimpleResponse]:
+        """
+        Process several event payloads concurrently
+        
+        Args:
+            payloads: EventPayloads to process
+            concurrency: Maximum number of payloads in flight at once
+            
+        Returns:
+            SimpleResponses in the same order as the payloads. A payload that
+            raises (e.g. an unknown model key) gets a failed response of its own.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        return await asyncio.gather(*[self._run(p, semaphore) for p in payloads])
+    
+    async def process_batch_offline(self, payloads: List[EventPayload], min_batch_size: int = OFFLINE_BATCH_MIN_SIZE,
+                                    concurrency: int = 8) -> List[SimpleResponse]:
+        """
+        Process event payloads through provider batch APIs where possible
+        
+        Payloads marked batchable are grouped by primary model. Each group of at
+        least min_batch_size on Anthropic or OpenAI is submitted as one batch
+        (about 50% cheaper, but results can take up to 24 hours). Requests that
+        fail inside a batch fall back to their remaining models online. All
+        other payloads are processed online as in process_batch.
+        
+        Args:
+            payloads: EventPayloads to process
+            min_batch_size: Smallest same-model group worth batching
+            concurrency: Maximum number of online payloads in flight at once
+            
+        Returns:
+            SimpleResponses in the same order as the payloads
+        """
+        responses: List[Optional[SimpleResponse]] = [None] * len(payloads)
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        # Group batchable payloads by primary model (tool calls are online only)
+        groups: Dict[str, List[int]] = defaultdict(list)
+        online: List[int] = []
+        for i, payload in enumerate(payloads):
+            if payload.batchable and not payload.tools and payload.models:
+                groups[payload.primary_model].append(i)
+            else:
+                online.append(i)
+        
+        jobs = []
+        for model_key, indices in groups.items():
+            # Unknown model keys are reported per payload by the online path
+            provider = batch_provider(AVAILABLE_MODELS[model_key]) if model_key in AVAILABLE_MODELS else None
+            if provider is None or len(indices) < min_batch_size:
+                online.extend(indices)
+                continue
+            model = (model_key, get_model_id(model_key), get_model_name(model_key))
+            jobs.append(self._run_offline_group(model, provider, indices, payloads, responses, semaphore))
+        
+        async def run_online(i: int):
+            responses[i] = await self._run(payloads[i], semaphore)
+        
+        await asyncio.gather(*jobs, *[run_online(i) for i in online])
+        return responses
+    
+    async def _run_offline_group(self, model: ResolvedModel, provider: str, indices: List[int], payloads: List[EventPayload],
+                                 responses: List[Optional[SimpleResponse]], semaphore: asyncio.Semaphore):
+        """Submit one same-model group as a provider batch and scatter the results back"""
+        model_key, model_id, model_name = model
+        logger.info("📦 Submitting %d requests for %s to the %s batch API", len(indices), model_name, provider)
+        
+        requests = [(str(i), self._build_messages(model_id, payloads[i]), payloads[i]) for i in indices]
+        try:
+            results = await run_provider_batch(provider, model_id, requests)
+        except Exception as e:
+            logger.error("❌ %s batch failed: %s", model_name, e)
+            results = {}
+        
+        async def finish(i: int):
+            payload = payloads[i]
+            result = results.get(str(i)) or {'success': False, 'error': f"{model_name} failed: no batch result"}
+            attempt = self._attempt_record(model, result)
+            if result['success']:
+                responses[i] = self._success_response(model, result, [attempt])
+                return
+            
+            # Fall back online to the remaining models
+            error_msg = f"All {len(payload.models)} models failed"
+            if not payload.fallback_models:
+                responses[i] = SimpleResponse(success=False, error=error_msg, attempts=[attempt])
+                return
+            fallback = msgspec.structs.replace(payload, models=payload.fallback_models)
+            response = await self._run(fallback, semaphore)
+            responses[i] = replace(
+                response,
+                attempts=[attempt] + response.attempts,
+                error=response.error and error_msg
+            )
+        
+        await asyncio.gather(*[finish(i) for i in indices])
 
 def main():
     """Example usage"""
     import sys
     from event_payload import get_example_payload, EXAMPLE_PAYLOADS
     
-    # Initialize handler
-    handler = SimpleLLMHandler()
-    
     # Check command line arguments
     if len(sys.argv) > 1:
         if sys.argv[1] == "models":
@@ -207,8 +858,10 @@ def main():
         # Default example
         payload = get_example_payload("quality_first", "Explain quantum computing in simple terms.")
     
-    # Process the payload
-    response = handler.process(payload)
+    # Initialize handler only once there is something to process
+    with SimpleLLMHandler() as handler:
+        # Process the payload
+        response = handler.process(payload)
     
     # Print results
     print(f"\n📊 Results:")
@@ -229,10 +882,10 @@ def main():
     if response.attempts:
         print(f"\n🔄 Attempt History:")
         for i, attempt in enumerate(response.attempts, 1):
-            status_icon = "✅" if attempt['status'] == 'success' else "❌"
-            print(f"  {i}. {attempt['name']}: {status_icon}")
-            if attempt['error']:
-                print(f"     Error: {attempt['error'][:80]}...")
+            status_icon = "✅" if attempt.status == 'success' else "❌"
+            print(f"  {i}. {attempt.name}: {status_icon}")
+            if attempt.error:
+                print(f"     Error: {attempt.error[:80]}...")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Provider Batch APIs
+Submit groups of requests to provider-native batch endpoints.
+Batches bill at roughly half the online price but can take up to 24 hours.
+"""
+
+import asyncio
+import logging
+import os
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+import httpx
+import litellm
+import orjson
+
+from event_payload import EventPayload
+
+logger = logging.getLogger(__name__)
+
+# Batch pricing relative to online requests
+BATCH_DISCOUNT = 0.5
+
+# Status polling backoff (seconds)
+BATCH_POLL_INITIAL_DELAY = 5.0
+BATCH_POLL_MAX_DELAY = 300.0
+
+ANTHROPIC_BATCHES_URL = "https://api.anthropic.com/v1/messages/batches"
+ANTHROPIC_VERSION = "2023-06-01"
+
+OPENAI_BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+# Provider limits per batch, larger groups are split into several batches
+ANTHROPIC_BATCH_MAX_REQUESTS = 100_000
+ANTHROPIC_BATCH_MAX_BYTES = 256 * 1024 * 1024
+OPENAI_BATCH_MAX_REQUESTS = 50_000
+OPENAI_BATCH_MAX_BYTES = 200 * 1024 * 1024
+
+# Headroom for the request envelope around the encoded entries
+BATCH_BYTES_MARGIN = 64 * 1024
+
+# One batch entry: (custom_id, chat messages, payload)
+BatchRequest = Tuple[str, List[Dict[str, Any]], EventPayload]
+
+def batch_provider(model_id: str) -> Optional[str]:
+    """Get the batch API provider for a LiteLLM model ID, or None if it has none"""
+    if model_id.startswith('claude'):
+        return 'anthropic'
+    if model_id.startswith('gpt-'):
+        return 'openai'
+    return None
+
+async def run_provider_batch(provider: str, model_id: str, requests: List[BatchRequest]) -> Dict[str, Dict[str, Any]]:
+    """
+    Run requests through a provider batch API and wait for the results
+
+    Groups larger than the provider's limits are split into several batches
+    that run concurrently.
+
+    Returns:
+        Result dicts (same shape as SimpleLLMHandler._call_model) keyed by
+        custom_id. Requests missing from the output should be treated as failed.
+    """
+    if provider == 'anthropic':
+        entries = [_anthropic_entry(model_id, request) for request in requests]
+        chunks = _chunks(entries, ANTHROPIC_BATCH_MAX_REQUESTS, ANTHROPIC_BATCH_MAX_BYTES)
+        jobs = [_run_anthropic_batch(model_id, chunk) for chunk in chunks]
+    elif provider == 'openai':
+        entries = [_openai_entry(model_id, request) for request in requests]
+        chunks = _chunks(entries, OPENAI_BATCH_MAX_REQUESTS, OPENAI_BATCH_MAX_BYTES)
+        jobs = [_run_openai_batch(model_id, chunk) for chunk in chunks]
+    else:
+        raise ValueError(f"No batch API for provider: {provider}")
+
+    if len(jobs) == 1:
+        return await jobs[0]
+
+    # A failed chunk only loses its own requests, which then fall back online
+    results = {}
+    for chunk_results in await asyncio.gather(*jobs, return_exceptions=True):
+        if isinstance(chunk_results, BaseException):
+            logger.error("❌ %s batch chunk failed: %s", model_id, chunk_results)
+            continue
+        results.update(chunk_results)
+    return results
+
+def _chunks(entries: List[bytes], max_requests: int, max_bytes: int) -> Iterator[List[bytes]]:
+    """Split encoded batch entries into groups within a provider's request and size limits"""
+    budget = max_bytes - BATCH_BYTES_MARGIN
+    chunk, size = [], 0
+    for entry in entries:
+        if chunk and (len(chunk) == max_requests or size + len(entry) + 1 > budget):
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(entry)
+        size += len(entry) + 1  # Separator (comma or newline)
+    if chunk:
+        yield chunk
+
+def _poll_delays():
+    """Exponential backoff delays for status polling"""
+    delay = BATCH_POLL_INITIAL_DELAY
+    while True:
+        yield delay
+        delay = min(BATCH_POLL_MAX_DELAY, delay * 2)
+
+def _batch_cost(model_id: str, prompt_tokens: int, completion_tokens: int) -> Optional[float]:
+    """Calculate the discounted batch cost if pricing is available"""
+    try:
+        prompt_cost, completion_cost = litellm.cost_per_token(
+            model=model_id, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens
+        )
+        return (prompt_cost + completion_cost) * BATCH_DISCOUNT
+    except Exception:
+        return None
+
+def _success(model_id: str, content: str, usage: Dict[str, Any], prompt_tokens: int, completion_tokens: int) -> Dict[str, Any]:
+    """Build a successful result dict"""
+    return {
+        'success': True,
+        'content': content,
+        'model_used': model_id,
+        'usage': usage,
+        'cost': _batch_cost(model_id, prompt_tokens, completion_tokens)
+    }
+
+def _anthropic_entry(model_id: str, request: BatchRequest) -> bytes:
+    """Encode one request for Anthropic's Message Batches API"""
+    custom_id, messages, payload = request
+    params = {
+        'model': model_id,
+        'max_tokens': payload.max_tokens,
+        'temperature': payload.temperature,
+        'messages': [m for m in messages if m['role'] != 'system'],
+    }
+    system = [m['content'] for m in messages if m['role'] == 'system']
+    if system:
+        params['system'] = system[0]
+    return orjson.dumps({'custom_id': custom_id, 'params': params})
+
+async def _run_anthropic_batch(model_id: str, entries: List[bytes]) -> Dict[str, Dict[str, Any]]:
+    """Run encoded requests through Anthropic's Message Batches API"""
+    headers = {
+        'x-api-key': os.getenv('ANTHROPIC_API_KEY', ''),
+        'anthropic-version': ANTHROPIC_VERSION,
+        'content-type': 'application/json',
+    }
+    body = b'{"requests":[' + b','.join(entries) + b']}'
+
+    async with httpx.AsyncClient(timeout=httpx.Timeout(60.0, connect=10.0)) as client:
+        response = await client.post(ANTHROPIC_BATCHES_URL, headers=headers, content=body)
+        response.raise_for_status()
+        batch = orjson.loads(response.content)
+
+        delays = _poll_delays()
+        while batch['processing_status'] != 'ended':
+            await asyncio.sleep(next(delays))
+            response = await client.get(f"{ANTHROPIC_BATCHES_URL}/{batch['id']}", headers=headers)
+            response.raise_for_status()
+            batch = orjson.loads(response.content)
+
+        # Stream the JSONL results line by line instead of buffering the whole file
+        results = {}
+        async with client.stream('GET', batch['results_url'], headers=headers) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.strip():
+                    continue
+                item = orjson.loads(line)
+                result = item['result']
+                if result['type'] == 'succeeded':
+                    message = result['message']
+                    content = ''.join(block.get('text', '') for block in message['content'] if block['type'] == 'text')
+                    usage = message['usage']
+                    results[item['custom_id']] = _success(
+                        model_id, content, usage, usage.get('input_tokens', 0), usage.get('output_tokens', 0)
+                    )
+                else:
+                    results[item['custom_id']] = {
+                        'success': False,
+                        'error': f"Batch request {result['type']}: {result.get('error')}"
+                    }
+    return results
+
+def _openai_entry(model_id: str, request: BatchRequest) -> bytes:
+    """Encode one request as a line of an OpenAI batch input file"""
+    custom_id, messages, payload = request
+    return orjson.dumps({
+        'custom_id': custom_id,
+        'method': 'POST',
+        'url': '/v1/chat/completions',
+        'body': {
+            'model': model_id,
+            'messages': messages,
+            'max_tokens': payload.max_tokens,
+            'temperature': payload.temperature,
+        }
+    })
+
+async def _run_openai_batch(model_id: str, entries: List[bytes]) -> Dict[str, Dict[str, Any]]:
+    """Run encoded requests through OpenAI's Batch API (via LiteLLM's files/batches helpers)"""
+    lines = b"\n".join(entries)
+
+    input_file = await litellm.acreate_file(file=('batch.jsonl', lines), purpose='batch', custom_llm_provider='openai')
+    batch = await litellm.acreate_batch(
+        completion_window='24h',
+        endpoint='/v1/chat/completions',
+        input_file_id=input_file.id,
+        custom_llm_provider='openai'
+    )
+
+    delays = _poll_delays()
+    while batch.status not in OPENAI_BATCH_TERMINAL_STATUSES:
+        await asyncio.sleep(next(delays))
+        batch = await litellm.aretrieve_batch(batch_id=batch.id, custom_llm_provider='openai')
+
+    results = {}
+    if not batch.output_file_id:
+        return results
+
+    output = await litellm.afile_content(file_id=batch.output_file_id, custom_llm_provider='openai')
+    for line in output.content.splitlines():
+        if not line.strip():
+            continue
+        item = orjson.loads(line)
+        response = item.get('response') or {}
+        if response.get('status_code') == 200:
+            body = response['body']
+            usage = body.get('usage') or {}
+            results[item['custom_id']] = _success(
+                model_id,
+                body['choices'][0]['message']['content'],
+                usage,
+                usage.get('prompt_tokens', 0),
+                usage.get('completion_tokens', 0)
+            )
+        else:
+            results[item['custom_id']] = {
+                'success': False,
+                'error': f"Batch request failed: {item.get('error') or response.get('body')}"
+            }
+    return results
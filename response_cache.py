@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Response Cache
+In-process cache for deterministic (temperature ~0) model responses
+"""
+
+import hashlib
+from typing import Dict, Any, Hashable, List, Optional, Tuple
+import orjson
+from cachetools import TTLCache
+
+# Only near-deterministic calls are cached, creative outputs always hit the provider
+MAX_CACHEABLE_TEMPERATURE = 0.01
+
+class ResponseCache:
+    """Exact-match response cache keyed by (model_key, content hash, max_tokens, temperature)"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600):
+        """Initialize the cache"""
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def is_cacheable(temperature: float) -> bool:
+        """Check whether a call with this temperature may be cached"""
+        return temperature <= MAX_CACHEABLE_TEMPERATURE
+
+    @staticmethod
+    def content_hash(prompt: str, system_prompt: Optional[str] = None,
+                     tools: Optional[List[Dict[str, Any]]] = None) -> bytes:
+        """Hash the model-independent request content (computed once per payload)"""
+        # One JSON array encodes every part unambiguously, so no two requests share a hash input
+        content = orjson.dumps([prompt, system_prompt, tools], option=orjson.OPT_SORT_KEYS)
+        return hashlib.blake2b(content, digest_size=16).digest()
+
+    @staticmethod
+    def make_key(model_key: str, content_hash: bytes, max_tokens: int, temperature: float) -> Tuple[Hashable, ...]:
+        """Build the cache key for a request to one model"""
+        return (model_key, content_hash, max_tokens, temperature)
+
+    def get(self, key: Tuple[Hashable, ...]) -> Optional[Dict[str, Any]]:
+        """Get a cached result, or None on a miss"""
+        result = self._entries.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def set(self, key: Tuple[Hashable, ...], result: Dict[str, Any]):
+        """Store a successful result"""
+        self._entries[key] = result
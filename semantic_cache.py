@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Semantic Cache
+Similarity cache that serves paraphrased prompts from earlier responses.
+Requires the optional fastembed package (pip install fastembed).
+"""
+
+import threading
+from typing import Dict, Any, Hashable, List, Optional, Tuple
+import numpy as np
+from fastembed import TextEmbedding
+
+# Cosine similarity above which two prompts are treated as the same question
+SIMILARITY_THRESHOLD = 0.92
+
+# Only low-temperature calls are cached, creative outputs always hit the provider
+MAX_CACHEABLE_TEMPERATURE = 0.1
+
+class SemanticCache:
+    """Embedding-based response cache for paraphrased prompts"""
+
+    def __init__(self, model_name: str = "BAAI/bge-small-en-v1.5", maxsize: int = 1024,
+                 threshold: float = SIMILARITY_THRESHOLD):
+        """Initialize the cache (the embedding model is loaded on first use)"""
+        self._model_name = model_name
+        self._embedder: Optional[TextEmbedding] = None
+        self._embedder_lock = threading.Lock()
+        self._maxsize = maxsize
+        self._threshold = threshold
+        # Namespace -> (unit-length embeddings, results), oldest first
+        self._entries: Dict[Hashable, Tuple[np.ndarray, List[Dict[str, Any]]]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def is_cacheable(temperature: float) -> bool:
+        """Check whether a call with this temperature may be cached"""
+        return temperature < MAX_CACHEABLE_TEMPERATURE
+
+    @property
+    def embedder(self) -> TextEmbedding:
+        """Local embedding model, loaded on first use so idle handlers start fast"""
+        if self._embedder is None:
+            with self._embedder_lock:
+                if self._embedder is None:
+                    self._embedder = TextEmbedding(model_name=self._model_name)
+        return self._embedder
+
+    def embed(self, prompt: str) -> np.ndarray:
+        """Embed a prompt as a unit-length vector (CPU bound)"""
+        vector = next(iter(self.embedder.embed([prompt])))
+        return vector / np.linalg.norm(vector)
+
+    def search(self, namespace: Hashable, embedding: np.ndarray) -> Optional[Dict[str, Any]]:
+        """Get the result of the most similar cached prompt, or None on a miss"""
+        entry = self._entries.get(namespace)
+        if entry is not None:
+            vectors, results = entry
+            scores = vectors @ embedding
+            best = int(np.argmax(scores))
+            if scores[best] >= self._threshold:
+                self.hits += 1
+                return results[best]
+        self.misses += 1
+        return None
+
+    def add(self, namespace: Hashable, embedding: np.ndarray, result: Dict[str, Any]):
+        """Store a successful result, evicting the oldest entry when full"""
+        if namespace in self._entries:
+            vectors, results = self._entries[namespace]
+            vectors = np.vstack([vectors, embedding])
+            results = results + [result]
+        else:
+            vectors, results = embedding[np.newaxis, :], [result]
+        self._entries[namespace] = (vectors[-self._maxsize:], results[-self._maxsize:])